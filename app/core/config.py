@@ -1,7 +1,57 @@
+import importlib.util
+import logging
+from functools import lru_cache
+from typing import Literal
+from pydantic import model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+logger = logging.getLogger(__name__)
+
 class Settings(BaseSettings):
     GROQ_API_KEY: str
+    # Minimum cosine similarity for a topic to be served from the semantic response cache.
+    SEMANTIC_CACHE_THRESHOLD: float = 0.95
+    SEMANTIC_CACHE_SIZE: int = 512
+    # Documents with fewer chunks than this use a flat index, which is faster at that size.
+    HNSW_MIN_CHUNKS: int = 500
+    USE_FLAT_INDEX: bool = False
+    # Store HNSW vectors as 8-bit scalars (4x smaller); disable to compare recall against FP32.
+    HNSW_SCALAR_QUANTIZE: bool = True
+    # Same for the exact flat index; worth it when USE_FLAT_INDEX is set for a large corpus.
+    FLAT_SCALAR_QUANTIZE: bool = False
+    # Approximate index for documents above HNSW_MIN_CHUNKS: "hnsw", or "ivf" (IVFFlat, with
+    # sqrt(n) clusters of which IVF_NPROBE are scanned per query).
+    FAISS_INDEX_TYPE: Literal["hnsw", "ivf"] = "hnsw"
+    IVF_NPROBE: int = 8
+    MAX_UPLOAD_MB: int = 50
+    # Maximum number of Groq calls in flight at once across all requests.
+    LLM_CONCURRENCY: int = 5
+    # Approximate cap on the retrieved context sent to Groq; prompt latency grows with its length.
+    MAX_CONTEXT_TOKENS: int = 4096
+    # Re-rank retrieved chunks with maximal marginal relevance so near-duplicates don't crowd the context.
+    USE_MMR: bool = False
+    MMR_LAMBDA: float = 0.5
+    # "onnx" runs the embedding model as an int8-quantized ONNX graph on CPU (needs optimum[onnxruntime]).
+    EMBEDDINGS_BACKEND: Literal["torch", "onnx"] = "torch"
+    # ONNX export to load from the model repo; pick the variant matching the CPU (e.g. model_qint8_arm64.onnx).
+    ONNX_MODEL_FILE: str = "onnx/model_quint8_avx2.onnx"
     model_config = SettingsConfigDict(env_file=".env")
 
-settings = Settings()
\ No newline at end of file
+    @model_validator(mode="after")
+    def _check_embeddings_backend(self) -> "Settings":
+        if self.EMBEDDINGS_BACKEND == "onnx":
+            missing = [name for name in ("optimum", "onnxruntime") if importlib.util.find_spec(name) is None]
+            if missing:
+                raise ValueError(
+                    f"EMBEDDINGS_BACKEND=onnx requires {', '.join(missing)}; "
+                    "install it with: pip install 'optimum[onnxruntime]'"
+                )
+        return self
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Returns the process-wide settings, read from the environment on first use."""
+    settings = Settings()
+    # Lazily formatted, so this costs nothing unless debug logging is enabled
+    logger.debug("Settings loaded (GROQ_API_KEY prefix=%s)", settings.GROQ_API_KEY[:7])
+    return settings
\ No newline at end of file
@@ -1,47 +1,120 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from .models.schemas import IngestResponse, ContentGenerationRequest
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, BackgroundTasks, UploadFile, File, Form, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from .core.config import get_settings
+from .models.schemas import IngestResponse, ContentGenerationRequest, BundleGenerationRequest
 from .services import document_service, qg_service
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # PDF parsing is CPU-bound, so it runs on a process pool shared by all requests
+    app.state.pdf_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+    yield
+    app.state.pdf_pool.shutdown()
+    await qg_service.close_llm()
+
 # Initialize the FastAPI app with metadata
 app = FastAPI(
     title="Agent Framework for Content Generation",
     description="An AI system to generate MCQs, Fill-in-the-Blanks, and Summaries from PDF files using a multi-agent workflow.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    # Generated question sets can be tens of KB; orjson encodes them several times faster
+    default_response_class=ORJSONResponse
 )
 
-@app.post("/ingest", response_model=IngestResponse)
-async def ingest_pdf(file: UploadFile = File(..., description="The PDF file to be processed.")):
+@app.middleware("http")
+async def reject_oversized_uploads(request: Request, call_next):
+    """
+    Rejects /ingest requests whose declared Content-Length exceeds the upload limit, before
+    the multipart body is read. Uploads that omit or understate it are still capped while streaming.
     """
-    Uploads and processes a PDF file. This endpoint:
+    if request.url.path == "/ingest":
+        content_length = request.headers.get("content-length", "")
+        max_upload_mb = get_settings().MAX_UPLOAD_MB
+        # Allow some headroom for the multipart boundaries and part headers
+        if content_length.isdigit() and int(content_length) > max_upload_mb * 1024 * 1024 + 64 * 1024:
+            return ORJSONResponse(status_code=413, content={"detail": f"File exceeds the {max_upload_mb} MB upload limit."})
+    return await call_next(request)
+
+async def _ingest_in_background(job_id: str, file_path, document_hash: str, append: bool):
+    if await document_service.run_ingest_job(job_id, file_path, document_hash, app.state.pdf_pool, append):
+        # Previously generated content refers to the old document
+        qg_service.clear_cache()
+
+@app.post("/ingest", response_model=IngestResponse, status_code=202)
+async def ingest_pdf(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(..., description="The PDF file to be processed."),
+    append: bool = Form(False, description="Add the PDF to the already ingested documents instead of replacing them."),
+):
+    """
+    Uploads a PDF file and queues it for processing. This endpoint:
     - Validates that the file is a PDF.
     - Saves the file to disk.
-    - Chunks the text and ingests it into a FAISS vector database.
-    - Returns the document's table of contents.
-    
-    This must be called successfully before using the /generate/content endpoint.
+    - Returns 202 Accepted with a job_id straight away.
+
+    In the background the text is chunked and ingested into a FAISS vector database. Poll
+    /ingest/status/{job_id} for progress; once it reports 'completed' it also carries the
+    document's table of contents and the /generate/content endpoint can be used.
+    With append=true the PDF is added to the existing vector store, embedding only its own chunks.
     """
     if file.content_type != 'application/pdf':
         raise HTTPException(status_code=400, detail="Invalid file type. Only PDF files are allowed.")
+    # The declared content type comes from the client, so also check the PDF signature
+    if await file.read(5) != b"%PDF-":
+        raise HTTPException(status_code=400, detail="Invalid file type. Only PDF files are allowed.")
+    await file.seek(0)
     
     # Delegate the core logic to the document service
-    result = await document_service.process_and_ingest_pdf(file)
-    return result
+    file_path, document_hash = await document_service.save_upload_for_ingest(file)
+    job = document_service.create_ingest_job(file.filename)
+    background_tasks.add_task(_ingest_in_background, job["job_id"], file_path, document_hash, append)
+    return job
+
+@app.get("/ingest/status/{job_id}", response_model=IngestResponse)
+def ingest_status(job_id: str):
+    """Reports the status of an ingestion job started by /ingest."""
+    job = document_service.get_ingest_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown ingestion job.")
+    return job
 
 @app.post("/generate/content", response_model=dict)
-def generate_content(request: ContentGenerationRequest):
+async def generate_content(request: ContentGenerationRequest, http_request: Request):
     """
     Generates content based on a topic from the ingested PDF. This endpoint:
-    - Takes a topic and a content_type ('MCQ', 'FillInTheBlank', or 'Summary').
+    - Takes a topic, a content_type ('MCQ', 'FillInTheBlank', or 'Summary'), num_questions
+      and context_chunks.
     - Orchestrates a multi-agent workflow that retrieves relevant documents
       and routes to a specialized agent for generation.
     - Returns the generated content as a JSON object.
+
+    Responses carry an ETag derived from the ingested document and the request, so clients
+    re-sending it in If-None-Match get a 304 without another LLM call.
     """
     try:
-        # Delegate the core logic to the question generation service
-        generated_data = qg_service.run_generation(request.topic, request.content_type)
+        etag = '"' + hashlib.sha256(
+            f"{document_service.get_document_hash()}|{request.model_dump_json()}".encode()
+        ).hexdigest()[:16] + '"'
+        if etag in (tag.strip() for tag in http_request.headers.get("If-None-Match", "").split(",")):
+            return Response(status_code=304, headers={"ETag": etag})
+
+        # Delegate the core logic to the question generation service. The Groq call is
+        # awaited natively, so the event loop keeps serving other requests meanwhile.
+        generated_data = await qg_service.run_generation(
+            request.topic, request.content_type, request.num_questions, request.context_chunks
+        )
         if not generated_data:
             raise HTTPException(status_code=404, detail="The agent could not generate content for the given topic. Please try another topic.")
-        return generated_data
+        # Serialized straight from the model, skipping FastAPI's dict validation and re-encoding
+        return Response(
+            content=generated_data.model_dump_json(), media_type="application/json",
+            headers={"ETag": etag, "Cache-Control": "private, max-age=3600"},
+        )
     except FileNotFoundError as e:
         # This custom exception is raised if the vector store doesn't exist
         raise HTTPException(status_code=400, detail=str(e))
@@ -49,6 +122,47 @@ def generate_content(request: ContentGenerationRequest):
         # Catch any other unexpected errors during the process
         raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
 
+@app.post("/generate/content/stream")
+async def generate_content_stream(request: ContentGenerationRequest, http_request: Request):
+    """
+    Streams generated content as newline-delimited JSON instead of waiting for the full result.
+    Each line is the content parsed so far (e.g. the questions completed up to that point),
+    so clients can start rendering after the first question rather than the last.
+    Clients sending `Accept: text/event-stream` get the same updates as Server-Sent Events.
+    """
+    sse = "text/event-stream" in http_request.headers.get("Accept", "")
+    try:
+        lines = await qg_service.stream_generation(
+            request.topic, request.content_type, request.num_questions, request.context_chunks, sse
+        )
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if sse:
+        return StreamingResponse(lines, media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+@app.post("/generate/bundle", response_model=dict)
+async def generate_bundle(request: BundleGenerationRequest):
+    """
+    Generates several content types for one topic in a single call. This endpoint:
+    - Takes a topic and a list of content_types ('MCQ', 'FillInTheBlank', 'Summary').
+    - Retrieves the relevant documents once and runs the specialized agents concurrently.
+    - Returns a JSON object keyed by content_type.
+    """
+    try:
+        generated_data = await qg_service.run_generation_multi(
+            request.topic, request.content_types, request.num_questions, request.context_chunks
+        )
+        if not all(generated_data.values()):
+            raise HTTPException(status_code=404, detail="The agent could not generate content for the given topic. Please try another topic.")
+        return generated_data
+    except HTTPException:
+        raise
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"An unexpected error occurred: {str(e)}")
+
 @app.get("/", include_in_schema=False)
 def root():
     """A simple root endpoint to confirm the API is running."""
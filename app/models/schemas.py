@@ -1,31 +1,48 @@
-from typing import List, Literal
-from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
+from pydantic import BaseModel, ConfigDict, Field
+
+# Upper bound on the chunks retrieved per request; the FAISS index is tuned for it
+MAX_CONTEXT_CHUNKS = 20
 
 # --- API Request/Response Models ---
 class IngestResponse(BaseModel):
     message: str
     table_of_contents: List[str]
+    job_id: Optional[str] = None
+    status: Optional[Literal["pending", "processing", "completed", "failed"]] = None
 
 class ContentGenerationRequest(BaseModel):
     topic: str
     content_type: Literal["MCQ", "FillInTheBlank", "Summary"]
+    num_questions: int = Field(3, ge=1, le=20, description="Number of questions to generate (ignored for summaries).")
+    context_chunks: int = Field(5, ge=1, le=MAX_CONTEXT_CHUNKS, description="Number of document chunks retrieved as context.")
+
+class BundleGenerationRequest(BaseModel):
+    topic: str
+    content_types: List[Literal["MCQ", "FillInTheBlank", "Summary"]] = Field(..., min_length=1)
+    num_questions: int = Field(3, ge=1, le=20, description="Number of questions to generate (ignored for summaries).")
+    context_chunks: int = Field(5, ge=1, le=MAX_CONTEXT_CHUNKS, description="Number of document chunks retrieved as context.")
 
 # --- Agent Output Models (must match the logic in qg_service.py) ---
-class MCQ(BaseModel):
+class AgentOutput(BaseModel):
+    # Parsed from every LLM response: immutable, and tolerant of extra keys the model emits
+    model_config = ConfigDict(extra='ignore', frozen=True)
+
+class MCQ(AgentOutput):
     question: str
     options: List[str]
     correct_answer: str
     explanation: str
 
-class MCQs(BaseModel):
+class MCQs(AgentOutput):
     questions: List[MCQ]
 
-class FillInTheBlank(BaseModel):
+class FillInTheBlank(AgentOutput):
     sentence: str
     correct_answer: str
 
-class FillInTheBlanks(BaseModel):
+class FillInTheBlanks(AgentOutput):
     questions: List[FillInTheBlank]
 
-class Summary(BaseModel):
+class Summary(AgentOutput):
     summary_text: str
\ No newline at end of file
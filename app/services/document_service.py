@@ -1,10 +1,33 @@
-import re
+import asyncio
+import hashlib
+import math
+import os
+import pickle
+import shutil
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor
+from contextlib import closing
+from functools import lru_cache
 from pathlib import Path
+from typing import Optional
+from uuid import uuid4
+import aiofiles
+import faiss
+import numpy as np
+import orjson
+import torch
 from fastapi import UploadFile, HTTPException
-from langchain_community.document_loaders import PyPDFLoader      # Corrected import
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.embeddings import HuggingFaceEmbeddings # Corrected import
 from langchain_community.vectorstores import FAISS               # Corrected import
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.documents import Document
+
+from ..core.config import get_settings
+from ..models.schemas import MAX_CONTEXT_CHUNKS
+from .pdf_worker import count_pages, extract_and_chunk, page_ranges
 
 # Define persistent storage directories
 UPLOAD_DIR = Path("uploads")
@@ -12,40 +35,408 @@ VECTOR_STORE_DIR = Path("vector_store")
 UPLOAD_DIR.mkdir(exist_ok=True)
 VECTOR_STORE_DIR.mkdir(exist_ok=True)
 VECTOR_STORE_PATH = str(VECTOR_STORE_DIR / "algebra_review.faiss")
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_CACHE_PATH = VECTOR_STORE_DIR / "embedding_cache.sqlite"
+
+_embeddings_model: Optional[HuggingFaceEmbeddings] = None
+_embeddings_lock = threading.Lock()
+
+def get_embeddings_model() -> HuggingFaceEmbeddings:
+    """
+    Loads the embedding model once per process: int8 ONNX when configured, otherwise
+    PyTorch on the GPU when one is available.
+    Ingest and generation threads may race here, so the first load happens under a lock.
+    """
+    global _embeddings_model
+    if _embeddings_model is None:
+        with _embeddings_lock:
+            if _embeddings_model is None:
+                if get_settings().EMBEDDINGS_BACKEND == "onnx":
+                    # Pre-quantized int8 export shipped with the model; about twice as fast as FP32 on CPU
+                    model_kwargs = {
+                        "device": "cpu",
+                        "backend": "onnx",
+                        "model_kwargs": {"file_name": get_settings().ONNX_MODEL_FILE},
+                    }
+                elif torch.cuda.is_available():
+                    # Half precision roughly doubles GPU encode throughput for MiniLM
+                    model_kwargs = {"device": "cuda", "model_kwargs": {"torch_dtype": torch.float16}}
+                else:
+                    model_kwargs = {"device": "cpu"}
+                # Chunks are embedded in large mini-batches, one forward pass per batch.
+                # sentence-transformers already sorts each call's inputs by length to limit padding.
+                _embeddings_model = HuggingFaceEmbeddings(
+                    model_name=EMBEDDING_MODEL_NAME,
+                    model_kwargs=model_kwargs,
+                    encode_kwargs={"batch_size": 128, "normalize_embeddings": True},
+                )
+    return _embeddings_model
+
+_vector_store: Optional[FAISS] = None
+_vector_store_version: Optional[Path] = None
+_vector_store_lock = threading.Lock()
+
+def load_vector_store() -> FAISS:
+    """
+    Returns the process-wide vector store, loading it on first use; raises FileNotFoundError
+    before the first ingest. Concurrent first requests share a single load.
+    The live version is checked on every call, so a worker picks up a store saved by any
+    other worker process and returns a new object for it.
+    """
+    global _vector_store, _vector_store_version
+    version = Path(VECTOR_STORE_PATH).resolve()
+    if _vector_store is None or _vector_store_version != version:
+        with _vector_store_lock:
+            if _vector_store is None or _vector_store_version != version:
+                _vector_store = _read_vector_store(store_dir=version)
+                _vector_store_version = version
+    return _vector_store
+
+def _read_vector_store(writable: bool = False, store_dir: Optional[Path] = None) -> FAISS:
+    """
+    Reads the persisted vector store. For serving, the FAISS index is memory-mapped read-only
+    (vector codes and graph included, for every index type), so worker processes share the OS
+    page cache instead of each holding a copy; `writable` loads it into memory instead so new
+    chunks can be appended.
+    """
+    # Resolve the live version once, so a concurrent save can't mix files from two versions
+    store_dir = store_dir or Path(VECTOR_STORE_PATH).resolve()
+    if not (store_dir / "index.faiss").exists():
+        raise FileNotFoundError("Vector store not found. Please ingest a document via the /ingest endpoint.")
+    # IO_FLAG_MMAP alone only maps IVF inverted lists; MMAP_IFC also maps flat and HNSW storage
+    io_flags = 0 if writable else faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+    index = faiss.read_index(str(store_dir / "index.faiss"), io_flags)
+    if (store_dir / "docstore.json").exists():
+        docstore, index_to_docstore_id = _read_docstore(store_dir / "docstore.json")
+    else:
+        # Stores written before docstore.json existed; save_vector_store wrote this pickle, so it is trusted
+        with open(store_dir / "index.pkl", "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+    # Tuned once for the largest allowed k, so requests never mutate the shared index
+    tune_index_for_search(index, MAX_CONTEXT_CHUNKS)
+    # Stores built before the switch to inner product still use L2
+    distance_strategy = (
+        DistanceStrategy.MAX_INNER_PRODUCT if index.metric_type == faiss.METRIC_INNER_PRODUCT
+        else DistanceStrategy.EUCLIDEAN_DISTANCE
+    )
+    return FAISS(get_embeddings_model(), index, docstore, index_to_docstore_id, distance_strategy=distance_strategy)
+
+def _write_docstore(vector_store: FAISS, path: Path):
+    """Writes the chunk texts and metadata in FAISS row order as a single JSON document."""
+    ids = [vector_store.index_to_docstore_id[i] for i in range(len(vector_store.index_to_docstore_id))]
+    documents = [vector_store.docstore.search(doc_id) for doc_id in ids]
+    path.write_bytes(orjson.dumps({
+        "ids": ids,
+        "documents": [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in documents],
+    }))
 
-def get_embeddings_model():
-    """Loads the embedding model."""
-    return HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+def _read_docstore(path: Path) -> tuple[InMemoryDocstore, dict[int, str]]:
+    """Rebuilds the docstore and row-to-id map written by _write_docstore."""
+    data = orjson.loads(path.read_bytes())
+    ids = data["ids"]
+    docstore = InMemoryDocstore({doc_id: Document(**doc) for doc_id, doc in zip(ids, data["documents"])})
+    return docstore, dict(enumerate(ids))
 
-async def process_and_ingest_pdf(file: UploadFile):
-    """Handles the logic for ingesting a PDF file."""
-    file_path = UPLOAD_DIR / file.filename
+def get_document_hash() -> str:
+    """
+    Identifies the current vector store: the SHA-256 of each PDF it was built from, one per
+    line in ingest order. Read per store version, so a save by another worker is seen at once.
+    Stores written by `save_local` have no hash file; they are identified by their index instead.
+    """
+    return _read_document_hash(Path(VECTOR_STORE_PATH).resolve())
+
+@lru_cache(maxsize=4)
+def _read_document_hash(store_dir: Path) -> str:
+    hash_file = store_dir / "document.sha256"
+    if hash_file.exists():
+        return hash_file.read_text()
+    index_file = store_dir / "index.faiss"
+    if not index_file.exists():
+        raise FileNotFoundError("Vector store not found. Please ingest a document via the /ingest endpoint.")
+    digest = hashlib.sha256()
+    with open(index_file, "rb") as f:
+        while chunk := f.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def save_vector_store(vector_store: FAISS, document_hash: str):
+    """
+    Writes the store to a new version directory, atomically repoints the VECTOR_STORE_PATH
+    symlink at it and drops the cached copies. Readers see either the old version or the new
+    one, never a mix. The index and docstore are written separately so loading never unpickles anything.
+    """
+    global _vector_store
+    store_link = Path(VECTOR_STORE_PATH)
+    version_dir = Path(f"{VECTOR_STORE_PATH}.{uuid4().hex}")
+    version_dir.mkdir()
+    try:
+        faiss.write_index(vector_store.index, str(version_dir / "index.faiss"))
+        _write_docstore(vector_store, version_dir / "docstore.json")
+        (version_dir / "document.sha256").write_text(document_hash)
+        previous = store_link.resolve() if store_link.exists() else None
+        if store_link.is_dir() and not store_link.is_symlink():
+            # A store saved before versioned directories; move it aside so the link can replace it
+            previous = Path(f"{VECTOR_STORE_PATH}.{uuid4().hex}")
+            os.rename(store_link, previous)
+        if previous is not None:
+            (version_dir / "replaces").write_text(previous.name)
+        tmp_link = Path(f"{VECTOR_STORE_PATH}.link-{uuid4().hex}")
+        tmp_link.symlink_to(version_dir.name)
+        os.replace(tmp_link, store_link)
+    except BaseException:
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+    # Keep the version just replaced for readers that resolved it a moment ago; the one it
+    # replaced has been retired for a whole save and can go
+    if previous is not None and (previous / "replaces").exists():
+        shutil.rmtree(VECTOR_STORE_DIR / (previous / "replaces").read_text(), ignore_errors=True)
+    with _vector_store_lock:
+        _vector_store = None
+
+def is_current_document(document_hash: str, append: bool = False) -> bool:
+    """
+    Returns True if ingesting the PDF with this hash would leave the vector store unchanged:
+    it already holds that PDF (when appending) or only that PDF (when replacing).
+    """
     try:
-        with open(file_path, "wb") as buffer:
-            buffer.write(await file.read())
+        ingested = get_document_hash().split()
+    except FileNotFoundError:
+        return False
+    return document_hash in ingested if append else ingested == [document_hash]
+
+def build_faiss_index(vectors: np.ndarray) -> faiss.Index:
+    """
+    Picks and trains an empty FAISS index for a corpus: HNSW (8-bit scalar quantized by
+    default) or IVFFlat for sub-linear search, flat (optionally 8-bit) for small documents.
+    Vectors are unit length, so every index ranks by inner product, i.e. cosine similarity.
+    """
+    settings = get_settings()
+    num_vectors, dim = vectors.shape
+    if settings.USE_FLAT_INDEX or num_vectors < settings.HNSW_MIN_CHUNKS:
+        if not settings.FLAT_SCALAR_QUANTIZE:
+            return faiss.IndexFlatIP(dim)
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        index.train(vectors)
+        return index
+    if settings.FAISS_INDEX_TYPE == "ivf":
+        nlist = max(4, int(math.sqrt(num_vectors)))
+        index = faiss.IndexIVFFlat(faiss.IndexFlatIP(dim), dim, nlist, faiss.METRIC_INNER_PRODUCT)
+        index.train(vectors)
+        # MMR re-ranking reconstructs candidate vectors, which IVF can only do through a direct map
+        index.make_direct_map()
+        return index
+    if settings.HNSW_SCALAR_QUANTIZE:
+        index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, 32, faiss.METRIC_INNER_PRODUCT)
+    else:
+        index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = 200
+    if not index.is_trained:
+        index.train(vectors)
+    return index
+
+def tune_index_for_search(index: faiss.Index, k: int):
+    """Sets the HNSW search breadth for top-k queries, or the IVF probe count; a no-op for flat indexes."""
+    if isinstance(index, faiss.IndexHNSW):
+        # efSearch=64 keeps recall above 95% at M=32; widen it for larger k
+        index.hnsw.efSearch = max(64, 4 * k)
+    elif isinstance(index, faiss.IndexIVF):
+        index.nprobe = get_settings().IVF_NPROBE
+        # IVF stores built without a direct map can't serve MMR's reconstruct() calls
+        if index.direct_map.type == faiss.DirectMap.NoMap:
+            index.make_direct_map()
+
+async def save_upload(file: UploadFile, destination: Path) -> str:
+    """
+    Streams an upload to disk in fixed-size chunks, enforcing the configured size limit.
+    Returns the file's SHA-256, computed in the same pass so the file is never re-read.
+    """
+    max_upload_mb = get_settings().MAX_UPLOAD_MB
+    digest = hashlib.sha256()
+    written = 0
+    try:
+        async with aiofiles.open(destination, "wb") as buffer:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                written += len(chunk)
+                if written > max_upload_mb * 1024 * 1024:
+                    raise HTTPException(status_code=413, detail=f"File exceeds the {max_upload_mb} MB upload limit.")
+                digest.update(chunk)
+                await buffer.write(chunk)
+    except HTTPException:
+        destination.unlink(missing_ok=True)
+        raise
     except Exception:
+        destination.unlink(missing_ok=True)
         raise HTTPException(status_code=500, detail="Could not save uploaded file.")
+    return digest.hexdigest()
+
+# --- Ingestion Jobs ---
+# In-process registry of background ingestion jobs, newest last
+MAX_TRACKED_JOBS = 1000
+_ingest_jobs: OrderedDict[str, dict] = OrderedDict()
+
+def create_ingest_job(filename: str) -> dict:
+    """
+    Registers a pending ingestion job and returns its status record. Beyond MAX_TRACKED_JOBS the
+    oldest finished jobs are forgotten; pending and processing jobs are always kept.
+    """
+    job_id = uuid4().hex
+    _ingest_jobs[job_id] = {
+        "job_id": job_id,
+        "status": "pending",
+        "message": f"File '{filename}' accepted for processing.",
+        "table_of_contents": [],
+    }
+    if len(_ingest_jobs) > MAX_TRACKED_JOBS:
+        finished = [key for key, job in _ingest_jobs.items() if job["status"] in ("completed", "failed")]
+        for key in finished[:len(_ingest_jobs) - MAX_TRACKED_JOBS]:
+            del _ingest_jobs[key]
+    return _ingest_jobs[job_id]
+
+def get_ingest_job(job_id: str) -> Optional[dict]:
+    return _ingest_jobs.get(job_id)
+
+async def save_upload_for_ingest(file: UploadFile) -> tuple[Path, str]:
+    """
+    Saves an uploaded PDF to the uploads directory and returns its path and SHA-256. Each upload
+    gets its own subdirectory, so a later upload with the same name can't replace the file
+    before its background job has parsed it.
+    """
+    upload_dir = UPLOAD_DIR / uuid4().hex
+    upload_dir.mkdir()
+    file_path = upload_dir / Path(file.filename).name
+    try:
+        document_hash = await save_upload(file, file_path)
+    except HTTPException:
+        upload_dir.rmdir()
+        raise
+    return file_path, document_hash
+
+def _embedding_cache_key(text: str) -> bytes:
+    """Keys a chunk's cached vector by its text and the model that produced it."""
+    settings = get_settings()
+    model_id = f"{EMBEDDING_MODEL_NAME}:{settings.EMBEDDINGS_BACKEND}"
+    if settings.EMBEDDINGS_BACKEND == "onnx":
+        # Each ONNX export is quantized differently, so their vectors aren't interchangeable
+        model_id += f":{settings.ONNX_MODEL_FILE}"
+    return hashlib.blake2b(f"{model_id}\0{text}".encode(), digest_size=16).digest()
 
-    loader = PyPDFLoader(str(file_path))
-    docs = loader.load()
+def embed_chunks(texts: list[str]) -> np.ndarray:
+    """
+    Embeds chunk texts, reusing the vectors of chunks seen in earlier ingests so re-uploading
+    a document (or overlapping content) skips the model for everything it has already embedded.
+    """
+    keys = [_embedding_cache_key(text) for text in texts]
+    cached: dict[bytes, np.ndarray] = {}
+    with closing(sqlite3.connect(EMBEDDING_CACHE_PATH)) as conn, conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL)")
+        unique_keys = list(dict.fromkeys(keys))
+        # Stay well under SQLite's bound-parameter limit
+        for i in range(0, len(unique_keys), 500):
+            batch = unique_keys[i:i + 500]
+            rows = conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+            )
+            cached.update((key, np.frombuffer(vector, dtype="float32")) for key, vector in rows)
 
-    toc = []
-    if docs:
-        first_page_text = docs[0].page_content
-        for line in first_page_text.split('\n'):
-            if re.match(r'^\d{1,2}\.\s', line):
-                toc.append(line.strip())
+        misses = {key: text for key, text in zip(keys, texts) if key not in cached}
+        if misses:
+            new_vectors = np.asarray(get_embeddings_model().embed_documents(list(misses.values())), dtype="float32")
+            # The model already normalizes; this guarantees it for the inner-product index
+            faiss.normalize_L2(new_vectors)
+            cached.update(zip(misses, new_vectors))
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+                ((key, vector.tobytes()) for key, vector in zip(misses, new_vectors)),
+            )
+    return np.stack([cached[key] for key in keys])
 
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    splits = text_splitter.split_documents(docs)
+# Serializes read-modify-write of the store, so concurrent appends each build on the previous one
+_ingest_lock = threading.Lock()
+
+def _build_and_save_vector_store(splits: list[Document], document_hash: str, append: bool = False) -> bool:
+    """
+    Embeds the chunks, indexes them and swaps the result in as the live vector store.
+    With `append`, only the new chunks are embedded and added to the existing index.
+    Returns False, without touching the store, if a concurrent job already ingested this PDF.
+    """
+    embeddings = get_embeddings_model()
+    texts = [doc.page_content for doc in splits]
+    vectors = embed_chunks(texts)
+    with _ingest_lock:
+        if is_current_document(document_hash, append):
+            return False
+        if append and (Path(VECTOR_STORE_PATH) / "index.faiss").exists():
+            vector_store = _read_vector_store(writable=True)
+            document_hash = f"{get_document_hash()}\n{document_hash}"
+        else:
+            vector_store = FAISS(
+                embedding_function=embeddings,
+                index=build_faiss_index(vectors),
+                docstore=InMemoryDocstore(),
+                index_to_docstore_id={},
+                distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+            )
+        vector_store.add_embeddings(zip(texts, vectors), metadatas=[doc.metadata for doc in splits])
+        save_vector_store(vector_store, document_hash)
+    return True
+
+async def process_and_ingest_pdf(
+    file_path: Path, document_hash: str, executor: Optional[Executor] = None, append: bool = False
+) -> tuple[dict, bool]:
+    """
+    Handles the logic for ingesting a saved PDF file.
+    Parsing and chunking run on `executor` (the app's process pool) so they don't block the event
+    loop; the pages are split into one range per CPU and parsed in parallel.
+    With `append` the PDF is added to the existing vector store instead of replacing it.
+    Re-uploading a document the store already holds only parses its first page, for the table
+    of contents. Returns the job result and whether the vector store changed.
+    """
+    loop = asyncio.get_running_loop()
+    if is_current_document(document_hash, append):
+        toc, _ = await loop.run_in_executor(executor, extract_and_chunk, str(file_path), 0, 1)
+        return {"message": f"File '{file_path.name}' is already ingested.", "table_of_contents": toc}, False
+
+    num_pages = await loop.run_in_executor(executor, count_pages, str(file_path))
+    results = await asyncio.gather(*(
+        loop.run_in_executor(executor, extract_and_chunk, str(file_path), start, end)
+        for start, end in page_ranges(num_pages, os.cpu_count() or 1)
+    ))
+    # Only the range holding the first page carries the table of contents
+    toc = results[0][0] if results else []
+    splits = [split for _, range_splits in results for split in range_splits]
+    already_ingested = {"message": f"File '{file_path.name}' is already ingested.", "table_of_contents": toc}
     if not splits:
         raise HTTPException(status_code=400, detail="Could not extract text from the PDF.")
 
     try:
-        embeddings = get_embeddings_model()
-        vector_store = FAISS.from_documents(documents=splits, embedding=embeddings)
-        vector_store.save_local(VECTOR_STORE_PATH)
+        # Embedding and indexing are CPU/GPU-bound, so keep them off the event loop
+        changed = await asyncio.to_thread(_build_and_save_vector_store, splits, document_hash, append)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to create vector store: {e}")
+    if not changed:
+        return already_ingested, False
 
-    return {"message": f"File '{file.filename}' processed successfully.", "table_of_contents": toc}
\ No newline at end of file
+    return {"message": f"File '{file_path.name}' processed successfully.", "table_of_contents": toc}, True
+
+async def run_ingest_job(
+    job_id: str, file_path: Path, document_hash: str, executor: Optional[Executor] = None, append: bool = False
+) -> bool:
+    """
+    Runs an ingestion job to completion, recording the outcome. Returns True if the vector store changed.
+    The uploaded PDF is only needed for parsing, so its upload directory is removed once the job ends.
+    """
+    # A record can't normally be evicted while pending; if it is gone, still run the job
+    job = _ingest_jobs.get(job_id, {})
+    job["status"] = "processing"
+    try:
+        result, store_changes = await process_and_ingest_pdf(file_path, document_hash, executor, append)
+    except Exception as e:
+        detail = e.detail if isinstance(e, HTTPException) else str(e)
+        job.update(status="failed", message=detail)
+        return False
+    finally:
+        if file_path.parent.parent == UPLOAD_DIR:
+            shutil.rmtree(file_path.parent, ignore_errors=True)
+    job.update(status="completed", **result)
+    return store_changes
\ No newline at end of file
@@ -0,0 +1,34 @@
+import re
+from typing import Optional
+from pypdf import PdfReader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+
+# Numbered section headings ("1. Simplifying Expressions") on the first page form the TOC
+_TOC_RE = re.compile(r'^\d{1,2}\.[^\S\n].*$', re.MULTILINE)
+
+def count_pages(path: str) -> int:
+    """Returns the number of pages in a PDF without extracting any text."""
+    return len(PdfReader(path).pages)
+
+def page_ranges(num_pages: int, num_workers: int) -> list[tuple[int, int]]:
+    """Splits [0, num_pages) into at most `num_workers` contiguous, near-equal ranges."""
+    step = max(1, -(-num_pages // max(1, num_workers)))
+    return [(start, min(start + step, num_pages)) for start in range(0, num_pages, step)]
+
+def extract_and_chunk(path: str, start: int = 0, end: Optional[int] = None) -> tuple[list[str], list[Document]]:
+    """
+    Parses pages [start, end) of a PDF into text chunks, plus the table of contents when the
+    range includes the first page. Chunks never span pages, so ranges can be parsed independently.
+    Runs inside a worker process, so it must stay a top-level function with picklable results.
+    """
+    reader = PdfReader(path)
+    docs = [
+        Document(page_content=page.extract_text(), metadata={"source": path, "page": i})
+        for i, page in enumerate(reader.pages[start:end], start)
+    ]
+
+    toc = [match.strip() for match in _TOC_RE.findall(docs[0].page_content)] if docs and start == 0 else []
+
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+    return toc, text_splitter.split_documents(docs)
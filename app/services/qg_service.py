@@ -1,75 +1,395 @@
-from typing import Literal, TypedDict # <--- ADD TypedDict HERE
-from pathlib import Path
+import asyncio
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Annotated, Literal, Optional, TypedDict # <--- ADD TypedDict HERE
 from fastapi import HTTPException
 
+import faiss
+import httpx
+import numpy as np
+
 from langchain_groq import ChatGroq
 from langchain.prompts import ChatPromptTemplate
-from langchain_community.vectorstores import FAISS # <--- Use the new import path
 from langgraph.graph import StateGraph, END
+from langgraph.types import Send
 
-from ..core.config import settings
-from .document_service import get_embeddings_model, VECTOR_STORE_PATH
+from ..core.config import get_settings
+from .document_service import get_embeddings_model, load_vector_store
 # vvv REMOVE GraphState FROM THIS IMPORT vvv
-from ..models.schemas import MCQs, FillInTheBlanks, Summary
+from ..models.schemas import AgentOutput, MCQ, MCQs, FillInTheBlanks, Summary
+
+def _merge_outputs(left: dict, right: dict) -> dict:
+    return {**left, **right}
 
 # --- Define GraphState HERE, where it is used ---
 class GraphState(TypedDict):
     topic: str
-    content_type: Literal["MCQ", "FillInTheBlank", "Summary"]
+    content_types: list[Literal["MCQ", "FillInTheBlank", "Summary"]]
+    num_questions: int
+    context_chunks: int
+    topic_vector: np.ndarray
     documents: list[str]
-    final_output: dict
+    # Prompt context built once from `documents` and shared by every agent
+    context: str
+    # Agents run in parallel and each adds its own content type's result
+    outputs: Annotated[dict, _merge_outputs]
+
+# Larger question sets are split into near-equal batches of at most this size, generated in parallel
+MAX_QUESTIONS_PER_CALL = 5
+# Rough characters-per-token ratio for English text, used to budget the context
+CHARS_PER_TOKEN = 4
+_WHITESPACE_RE = re.compile(r"\s+")
 
 # --- Initialize LLM and Vector Store Components ---
-llm = ChatGroq(model="llama3-8b-8192", temperature=0, api_key=settings.GROQ_API_KEY)
+@lru_cache(maxsize=1)
+def get_llm() -> ChatGroq:
+    """
+    Builds the Groq chat client once and reuses it (and its connection pool) across requests.
+    HTTP/2 multiplexes concurrent agent calls over a few kept-alive TLS connections.
+    """
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=128, max_keepalive_connections=64),
+        timeout=60.0,
+    )
+    # temperature=0 and a pinned seed keep output stable for the /generate/content ETag
+    return ChatGroq(
+        model="llama3-8b-8192", temperature=0, model_kwargs={"seed": 0},
+        api_key=get_settings().GROQ_API_KEY, http_async_client=http_client
+    )
+
+async def close_llm():
+    """Closes the pooled Groq connections. Called on application shutdown."""
+    if get_llm.cache_info().currsize:
+        await get_llm().http_async_client.aclose()
+        get_llm.cache_clear()
+        _get_chain.cache_clear()
+
+@lru_cache(maxsize=1)
+def _get_llm_slots() -> asyncio.Semaphore:
+    """Concurrent requests queue here for a slot instead of tripping Groq's rate limit."""
+    return asyncio.Semaphore(get_settings().LLM_CONCURRENCY)
+
+async def _invoke_chain(chain, payload: dict):
+    async with _get_llm_slots():
+        return await chain.ainvoke(payload)
+
+def build_context(documents: list[str]) -> str:
+    """
+    Joins retrieved chunks into the prompt context. Whitespace runs are collapsed, chunks that
+    open like an earlier one are dropped, and the result is capped at MAX_CONTEXT_TOKENS.
+    """
+    budget = get_settings().MAX_CONTEXT_TOKENS * CHARS_PER_TOKEN
+    seen, parts, used = set(), [], 0
+    for document in documents:
+        text = _WHITESPACE_RE.sub(" ", document).strip()
+        if not text or text[:256] in seen:
+            continue
+        seen.add(text[:256])
+        if used + len(text) > budget:
+            remaining = budget - used
+            if remaining > 0:
+                parts.append(text[:remaining])
+            break
+        parts.append(text)
+        used += len(text) + 2
+    return "\n\n".join(parts)
+
+def _question_key(question) -> str:
+    text = question.question if isinstance(question, MCQ) else question.sentence
+    return _WHITESPACE_RE.sub(" ", text).strip().lower()
+
+async def _generate_questions(chain, state: GraphState, schema):
+    """
+    Generates all requested questions in one LLM call, or several parallel calls for large sets.
+    Generation is deterministic, so each batch is told which batch it is to steer it to other
+    parts of the context, and any question repeated across batches is dropped.
+    """
+    context = state["context"]
+    total = state["num_questions"]
+    if total <= MAX_QUESTIONS_PER_CALL:
+        return await _invoke_chain(chain, {"context": context, "num_questions": total})
+    num_batches = -(-total // MAX_QUESTIONS_PER_CALL)
+    sizes = [total // num_batches + (i < total % num_batches) for i in range(num_batches)]
+    payloads = [
+        {
+            "context": context, "num_questions": n,
+            "batch_note": f"\n**Batch:** {i + 1} of {num_batches}. Cover different facts from the "
+                          f"context than the other batches, so no question repeats one of theirs.",
+        }
+        for i, n in enumerate(sizes)
+    ]
+    results = await asyncio.gather(*(_invoke_chain(chain, payload) for payload in payloads))
+    questions = {}
+    for result in results:
+        for question in result.questions:
+            questions.setdefault(_question_key(question), question)
+    return schema(questions=list(questions.values()))
+
+# --- Semantic Response Cache ---
+class SemanticCache:
+    """
+    Caches generated content in two tiers: an exact match on the request key, then a
+    cosine-similarity match of the topic embedding against previously served topics.
+    Keys are `(topic, *params)`; a semantic hit requires the params to match exactly.
+    Values are the agents' frozen output models, so one entry can be served to many requests.
+    """
+
+    def __init__(self, threshold: float, max_size: int, dim: int = 384):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.dim = dim
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(self.dim))
+        self._entries: OrderedDict[tuple, tuple[int, AgentOutput]] = OrderedDict()
+        self._keys_by_id: dict[int, tuple] = {}
+        self._next_id = 0
+
+    def get_exact(self, key: tuple) -> Optional[AgentOutput]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    @staticmethod
+    def _as_query(vector: np.ndarray) -> np.ndarray:
+        query = np.array([vector], dtype="float32")
+        faiss.normalize_L2(query)
+        return query
+
+    def get_similar(self, key: tuple, vector: np.ndarray) -> Optional[AgentOutput]:
+        """Returns the closest cached response whose topic clears the similarity threshold."""
+        with self._lock:
+            if self._index.ntotal == 0:
+                return None
+            scores, ids = self._index.search(self._as_query(vector), min(8, self._index.ntotal))
+            for score, entry_id in zip(scores[0], ids[0]):
+                if score < self.threshold:
+                    break
+                cached_key = self._keys_by_id.get(int(entry_id))
+                if cached_key is not None and cached_key[1:] == key[1:]:
+                    self._entries.move_to_end(cached_key)
+                    return self._entries[cached_key][1]
+            return None
+
+    def put(self, key: tuple, vector: np.ndarray, response: AgentOutput):
+        with self._lock:
+            if key in self._entries:
+                return
+            entry_id = self._next_id
+            self._next_id += 1
+            self._index.add_with_ids(self._as_query(vector), np.array([entry_id], dtype="int64"))
+            self._entries[key] = (entry_id, response)
+            self._keys_by_id[entry_id] = key
+            # Evict least recently used entries from both tiers
+            while len(self._entries) > self.max_size:
+                old_key, (old_id, _) = self._entries.popitem(last=False)
+                del self._keys_by_id[old_id]
+                self._index.remove_ids(np.array([old_id], dtype="int64"))
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+@lru_cache(maxsize=1)
+def get_response_cache() -> SemanticCache:
+    """Returns the process-wide response cache, sized from the settings on first use."""
+    settings = get_settings()
+    return SemanticCache(settings.SEMANTIC_CACHE_THRESHOLD, settings.SEMANTIC_CACHE_SIZE)
+
+# --- Topic Embeddings ---
+MAX_TOPIC_VECTORS = 4096
+# Topics arriving within this window of each other are embedded in one batch
+EMBED_BATCH_WAIT = 0.005
+EMBED_BATCH_SIZE = 32
+_topic_vectors: OrderedDict[str, np.ndarray] = OrderedDict()
+_topic_vectors_lock = threading.Lock()
+
+def _topic_key(topic: str) -> str:
+    # The MiniLM tokenizer is uncased, so topics differing only in case or surrounding
+    # whitespace share an entry
+    return topic.strip().lower()
+
+def _embed_topics(keys: list[str]) -> np.ndarray:
+    """Embeds normalized topics in one forward pass and memoizes the vectors."""
+    vectors = np.array(get_embeddings_model().embed_documents(keys), dtype="float32")
+    # Unit length, so inner-product search over the vector store ranks by cosine similarity
+    faiss.normalize_L2(vectors)
+    with _topic_vectors_lock:
+        for key, vector in zip(keys, vectors):
+            _topic_vectors[key] = vector
+            _topic_vectors.move_to_end(key)
+        while len(_topic_vectors) > MAX_TOPIC_VECTORS:
+            _topic_vectors.popitem(last=False)
+    return vectors
+
+def _lookup_topic_vector(key: str) -> Optional[np.ndarray]:
+    with _topic_vectors_lock:
+        vector = _topic_vectors.get(key)
+        if vector is not None:
+            _topic_vectors.move_to_end(key)
+        return vector
+
+class EmbeddingBatcher:
+    """
+    Coalesces topic embeddings from concurrent requests. The first caller opens a short window;
+    every topic submitted before it closes (or the batch fills) is embedded in a single call.
+    """
+
+    def __init__(self, max_batch: int, max_wait: float):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._pending: list[tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def embed(self, key: str) -> np.ndarray:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((key, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        task = asyncio.get_running_loop().create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    async def _run(batch: list[tuple[str, asyncio.Future]]):
+        keys = list(dict.fromkeys(key for key, _ in batch))
+        try:
+            vectors = dict(zip(keys, await asyncio.to_thread(_embed_topics, keys)))
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for key, future in batch:
+            if not future.done():
+                future.set_result(vectors[key])
 
-try:
-    embeddings = get_embeddings_model()
-    # Note: allow_dangerous_deserialization is needed for FAISS. Trust your source files.
-    vector_store = FAISS.load_local(VECTOR_STORE_PATH, embeddings, allow_dangerous_deserialization=True)
-    retriever = vector_store.as_retriever(search_kwargs={'k': 5})
-except Exception:
-    retriever = None
+_topic_batcher = EmbeddingBatcher(EMBED_BATCH_SIZE, EMBED_BATCH_WAIT)
+
+async def embed_topic(topic: str) -> np.ndarray:
+    """
+    Embeds a topic once per request; the vector is shared by the cache and the retriever.
+    Vectors are memoized per topic, and misses from concurrent requests are batched.
+    """
+    key = _topic_key(topic)
+    vector = _lookup_topic_vector(key)
+    return vector if vector is not None else await _topic_batcher.embed(key)
+
+# Bumped on every ingest; requests started before the bump must not cache what they generated
+_cache_epoch = 0
+
+def clear_cache():
+    """Drops all cached responses and retrievals. Must be called whenever a new document is ingested."""
+    global _cache_epoch
+    _cache_epoch += 1
+    get_response_cache().clear()
+    _retrieve.cache_clear()
+
+_loaded_store = None
+
+def _sync_vector_store():
+    """
+    Loads the current vector store, failing with FileNotFoundError when nothing has been ingested.
+    A store saved by another worker process is a new object here, so the caches built from the
+    previous one are dropped before they can serve a stale response.
+    """
+    global _loaded_store
+    store = load_vector_store()
+    if _loaded_store is not None and store is not _loaded_store:
+        clear_cache()
+    _loaded_store = store
+
+# --- Agent Prompts and Chains ---
+# The instructions go in a byte-identical system message and only the per-request values in the
+# human message, so the provider's prompt-prefix cache can reuse the shared prefix across calls.
+MCQ_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """**Task:** Generate the requested number of multiple-choice questions based on the context. Your response must be a single, raw JSON object conforming to the MCQs schema."""),
+    ("human", "**Number of questions:** {num_questions}{batch_note}\n**Context:** {context}"),
+]).partial(batch_note="")
+
+FITB_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", '''**Task:** Generate the requested number of high-quality fill-in-the-blank questions based on the context. Your response must be a single, raw JSON object.
+    A good question replaces a single key term with '_________'.
+    **Example:** "When you have a negative exponent, it means _________."'''),
+    ("human", "**Number of questions:** {num_questions}{batch_note}\n**Context:** {context}"),
+]).partial(batch_note="")
+
+SUMMARY_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """**Task:** Generate a concise 2-3 sentence summary of the context. Your response must be a single, raw JSON object."""),
+    ("human", "**Context:** {context}"),
+])
+
+_PROMPTS = {MCQs: MCQ_PROMPT, FillInTheBlanks: FITB_PROMPT, Summary: SUMMARY_PROMPT}
+CONTENT_SCHEMAS = {"MCQ": MCQs, "FillInTheBlank": FillInTheBlanks, "Summary": Summary}
+
+@lru_cache(maxsize=None)
+def _get_chain(schema: type):
+    """Composes an agent's prompt with the structured-output LLM once per process."""
+    return _PROMPTS[schema] | get_llm().with_structured_output(schema)
 
 # --- Specialized Agent Nodes ---
-def retrieve_documents(state: GraphState) -> GraphState:
-    if retriever is None:
-        raise FileNotFoundError("Vector store not found. Please ingest a document first.")
-    documents = retriever.invoke(state["topic"])
-    return {"documents": [doc.page_content for doc in documents], **state}
-
-def mcq_agent(state: GraphState) -> GraphState:
-    prompt = ChatPromptTemplate.from_template(
-        """**Task:** Generate 3 multiple-choice questions based on the context. Your response must be a single, raw JSON object conforming to the MCQs schema.
-        **Context:** {context}"""
-    )
-    chain = prompt | llm.with_structured_output(MCQs)
-    result = chain.invoke({"context": "\n\n".join(state["documents"])})
-    return {"final_output": result.dict()}
-
-def fitb_agent(state: GraphState) -> GraphState:
-    prompt = ChatPromptTemplate.from_template(
-        """**Task:** Generate 3 high-quality fill-in-the-blank questions based on the context. Your response must be a single, raw JSON object.
-        A good question replaces a single key term with '_________'.
-        **Example:** "When you have a negative exponent, it means _________."
-        **Context:** {context}"""
-    )
-    chain = prompt | llm.with_structured_output(FillInTheBlanks)
-    result = chain.invoke({"context": "\n\n".join(state["documents"])})
-    return {"final_output": result.dict()}
-
-def summary_agent(state: GraphState) -> GraphState:
-    prompt = ChatPromptTemplate.from_template(
-        """**Task:** Generate a concise 2-3 sentence summary of the context. Your response must be a single, raw JSON object.
-        **Context:** {context}"""
-    )
-    chain = prompt | llm.with_structured_output(Summary)
-    result = chain.invoke({"context": "\n\n".join(state["documents"])})
-    return {"final_output": result.dict()}
+@lru_cache(maxsize=256)
+def _retrieve(topic_vector: bytes, k: int, epoch: int) -> tuple[str, ...]:
+    """
+    Searches the vector store with a topic's embedding (as bytes, so it can key the memo).
+    Memoized so the agents of repeated or back-to-back requests on one topic share a single
+    search; cleared on ingest. Keying on the ingest epoch keeps a search that was still running
+    on the old store when it was cleared from being served afterwards.
+    """
+    # k is passed per call rather than set on a shared retriever, so concurrent requests don't race
+    settings, topic_vector = get_settings(), np.frombuffer(topic_vector, dtype="float32")
+    if settings.USE_MMR:
+        documents = load_vector_store().max_marginal_relevance_search_by_vector(
+            topic_vector, k=k, fetch_k=4 * k, lambda_mult=settings.MMR_LAMBDA
+        )
+    else:
+        documents = load_vector_store().similarity_search_by_vector(topic_vector, k=k)
+    return tuple(doc.page_content for doc in documents)
+
+async def retrieve_documents(state: GraphState) -> GraphState:
+    # The search blocks (FAISS releases the GIL), so it runs on a worker thread off the event loop
+    documents = list(await asyncio.to_thread(
+        _retrieve, state["topic_vector"].tobytes(), state["context_chunks"], _cache_epoch
+    ))
+    return {"documents": documents, "context": build_context(documents), **state}
+
+async def mcq_agent(state: GraphState) -> GraphState:
+    result = await _generate_questions(_get_chain(MCQs), state, MCQs)
+    return {"outputs": {"MCQ": result}}
+
+async def fitb_agent(state: GraphState) -> GraphState:
+    result = await _generate_questions(_get_chain(FillInTheBlanks), state, FillInTheBlanks)
+    return {"outputs": {"FillInTheBlank": result}}
+
+async def summary_agent(state: GraphState) -> GraphState:
+    result = await _invoke_chain(_get_chain(Summary), {"context": state["context"]})
+    return {"outputs": {"Summary": result}}
 
 # --- Router Logic ---
-def route_to_agent(state: GraphState) -> str:
-    route_map = {"MCQ": "mcq_agent", "FillInTheBlank": "fitb_agent", "Summary": "summary_agent"}
-    return route_map[state['content_type']]
+AGENT_NODES = {"MCQ": "mcq_agent", "FillInTheBlank": "fitb_agent", "Summary": "summary_agent"}
+
+def route_to_agents(state: GraphState) -> list[Send]:
+    """Fans out to one agent per requested content type; they run concurrently in one step."""
+    return [Send(AGENT_NODES[content_type], state) for content_type in state["content_types"]]
 
 # --- Compile LangGraph Workflow ---
 workflow = StateGraph(GraphState)
@@ -78,31 +398,101 @@ workflow.add_node("mcq_agent", mcq_agent)
 workflow.add_node("fitb_agent", fitb_agent)
 workflow.add_node("summary_agent", summary_agent)
 workflow.set_entry_point("retriever")
-workflow.add_conditional_edges("retriever", route_to_agent, {
-    "mcq_agent": "mcq_agent", "fitb_agent": "fitb_agent", "summary_agent": "summary_agent"
-})
+workflow.add_conditional_edges("retriever", route_to_agents, list(AGENT_NODES.values()))
 workflow.add_edge("mcq_agent", END)
 workflow.add_edge("fitb_agent", END)
 workflow.add_edge("summary_agent", END)
 app_graph = workflow.compile()
 
 # --- Main Service Function ---
-def run_generation(topic: str, content_type: Literal["MCQ", "FillInTheBlank", "Summary"]):
-    """Invokes the graph to generate the specified content."""
-    global retriever
-    if retriever is None:
-        if not Path(VECTOR_STORE_PATH).exists():
-             raise FileNotFoundError("Vector store not found. Please ingest a document via the /ingest endpoint.")
-        try:
-             embeddings = get_embeddings_model()
-             vector_store = FAISS.load_local(VECTOR_STORE_PATH, embeddings, allow_dangerous_deserialization=True)
-             retriever = vector_store.as_retriever(search_kwargs={'k': 5})
-        except Exception as e:
-             raise RuntimeError(f"Could not load vector store after ingestion: {e}")
+async def run_generation(topic: str, content_type: Literal["MCQ", "FillInTheBlank", "Summary"], num_questions: int = 3, context_chunks: int = 5):
+    """
+    Invokes the graph to generate the specified content, serving repeated topics from cache.
+    Returns the output model; it is serialized to JSON once, at the API boundary.
+    """
+    # Fail fast with FileNotFoundError (a 400 at the API) when nothing has been ingested.
+    # Loading the store and embedding the topic block, so they run on worker threads.
+    await asyncio.to_thread(_sync_vector_store)
+    epoch = _cache_epoch
+    cache_key = (topic, content_type, num_questions, context_chunks)
+    cached = get_response_cache().get_exact(cache_key)
+    if cached is not None:
+        return cached
+
+    topic_vector = await embed_topic(topic)
+    cached = get_response_cache().get_similar(cache_key, topic_vector)
+    if cached is not None:
+        return cached
 
     try:
-        initial_state = {"topic": topic, "content_type": content_type}
-        final_state = app_graph.invoke(initial_state)
-        return final_state.get("final_output")
+        initial_state = {
+            "topic": topic, "content_types": [content_type], "num_questions": num_questions,
+            "context_chunks": context_chunks, "topic_vector": topic_vector,
+        }
+        final_state = await app_graph.ainvoke(initial_state)
+        final_output = final_state.get("outputs", {}).get(content_type)
+        # Content generated from a document replaced mid-request is returned but not cached
+        if final_output and epoch == _cache_epoch:
+            get_response_cache().put(cache_key, topic_vector, final_output)
+        return final_output
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"An error occurred during content generation: {e}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"An error occurred during content generation: {e}")
+
+async def run_generation_multi(topic: str, content_types: list[Literal["MCQ", "FillInTheBlank", "Summary"]], num_questions: int = 3, context_chunks: int = 5):
+    """
+    Generates several content types for one topic. The graph retrieves documents once and fans
+    out to the agents, whose Groq calls run concurrently; content types already in the cache are
+    served without a call.
+    """
+    content_types = list(dict.fromkeys(content_types))
+    await asyncio.to_thread(_sync_vector_store)
+    epoch = _cache_epoch
+    topic_vector = await embed_topic(topic)
+
+    results, pending = {}, []
+    for content_type in content_types:
+        cache_key = (topic, content_type, num_questions, context_chunks)
+        cache = get_response_cache()
+        cached = cache.get_exact(cache_key) or cache.get_similar(cache_key, topic_vector)
+        if cached is not None:
+            results[content_type] = cached
+        else:
+            pending.append(content_type)
+
+    if pending:
+        try:
+            final_state = await app_graph.ainvoke({
+                "topic": topic, "content_types": pending, "num_questions": num_questions,
+                "context_chunks": context_chunks, "topic_vector": topic_vector,
+            })
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"An error occurred during content generation: {e}")
+        outputs = final_state.get("outputs", {})
+        for content_type in pending:
+            results[content_type] = outputs.get(content_type)
+            if results[content_type] and epoch == _cache_epoch:
+                get_response_cache().put((topic, content_type, num_questions, context_chunks), topic_vector, results[content_type])
+
+    return {content_type: results[content_type] for content_type in content_types}
+
+async def stream_generation(topic: str, content_type: Literal["MCQ", "FillInTheBlank", "Summary"], num_questions: int = 3, context_chunks: int = 5, sse: bool = False):
+    """
+    Retrieves context and returns an async iterator of NDJSON lines (or, with `sse`, Server-Sent
+    Events), each holding the content parsed so far. Setup errors (e.g. no vector store) raise
+    here, before anything is streamed.
+    """
+    await asyncio.to_thread(_sync_vector_store)
+    topic_vector = await embed_topic(topic)
+    state = await retrieve_documents({
+        "topic": topic, "num_questions": num_questions,
+        "context_chunks": context_chunks, "topic_vector": topic_vector,
+    })
+    chain = _get_chain(CONTENT_SCHEMAS[content_type])
+    payload = {"context": state["context"], "num_questions": num_questions}
+
+    async def lines():
+        async with _get_llm_slots():
+            async for partial in chain.astream(payload):
+                yield f"data: {partial.model_dump_json()}\n\n" if sse else partial.model_dump_json() + "\n"
+
+    return lines()
\ No newline at end of file